@@ -0,0 +1,197 @@
+"""
+This module contains user defined functions for the congestion features: for each trip, the number of pickups in its pickup
+zone and the median speed of the trips from that zone that finished during the trailing 15 and 60 minutes before its pickup.
+Only the trips already known at the pickup time are used (pickups before it, and trips that were completed before it), so the
+features can be used both for the training data and for live predictions.
+
+In the batch mode the trips of every zone are sorted once by pickup and by dropoff time, the window boundaries are found with
+searchsorted on the sorted times, and the counts and speed histograms of the windows come from prefix sums. Windows with up to
+exact_max completed trips (most 15 minute windows outside Manhattan) get the exact median of their speeds, larger windows read
+it from the speed histogram (bins of speed_edges): the histogram median is within one bin width (2 mph by default) of the exact
+one, except that speeds above the last edge (60 mph) count as the last bin. In the streaming mode the same windows are kept up
+to date as the pickups and dropoffs arrive.
+"""
+import pandas as pd
+import numpy as np
+from collections import deque
+
+# Speed histogram bins in mph used for the window medians, speeds above the last edge go to the last bin
+speed_edges_default = np.arange(0, 62, 2.)
+
+def _to_seconds(times):
+    """
+    Converts a datetime column to int64 seconds.
+    """
+    return pd.to_datetime(times).to_numpy().astype('datetime64[s]').astype(np.int64)
+
+def _speed_bins(speed, edges):
+    """
+    Returns the histogram bin of every speed for the bin edges.
+    """
+    return np.clip(np.searchsorted(edges, speed, side = 'right') - 1, 0, len(edges) - 2)
+
+def _hist_median(hist, edges):
+    """
+    Interpolates the median of each row of the 2D histogram hist with the bin edges. Rows without counts get nan.
+    """
+    cum = hist.cumsum(axis = 1)
+    total = cum[:, -1]
+    target = total / 2.
+    idx = np.minimum((cum < target[:, None]).sum(axis = 1), hist.shape[1] - 1)
+    rows = np.arange(hist.shape[0])
+    prev = np.where(idx > 0, cum[rows, np.maximum(idx - 1, 0)], 0)
+    in_bin = hist[rows, idx]
+    frac = np.divide(target - prev, in_bin, out = np.zeros(len(target)), where = in_bin > 0)
+    median = edges[idx] + frac * (edges[idx + 1] - edges[idx])
+    median[total == 0] = np.nan
+    return median
+
+def _window_medians(values, lo, counts, width):
+    """
+    Exact medians of the windows values[lo:lo+counts] (counts between 1 and width), computed together on a (windows x width)
+    array padded with inf.
+    """
+    cols = np.arange(width)
+    idx = np.minimum(lo[:, None] + cols, len(values) - 1)
+    windows = np.where(cols < counts[:, None], values[idx], np.inf)
+    windows.sort(axis = 1)
+    rows = np.arange(len(lo))
+    return (windows[rows, (counts - 1) // 2] + windows[rows, counts // 2]) / 2.
+
+def trip_speed(df):
+    """
+    Average speed of every trip in mph from the haversine distance and the trip duration.
+    """
+    return df.distance_hav.to_numpy(dtype = np.float64) / (df.trip_duration.to_numpy(dtype = np.float64) / 3600)
+
+def add_congestion_features(df, windows = (15, 60), zone_col = 'pickup_taxizone_id', speed_edges = None, exact_max = 32):
+    """
+    Adds the trailing window congestion features to df (batch backfill):
+    zone_pickups_<w>m: number of pickups in the same zone during the w minutes before the pickup
+    zone_speed_<w>m: median speed (mph) of the trips picked up in the same zone and completed during the w minutes before
+                     the pickup. nan if no trip was completed in the window.
+    df: dataframe from prepare_dataframe with the zones assigned by assign_taxi_zones (trips can be in any order)
+    windows: window lengths in minutes
+    zone_col: column with the zone of every trip. Trips with a missing zone get nan.
+    speed_edges: bin edges of the speed histograms. default: 2 mph bins from 0 to 60 mph
+    exact_max: windows with at most exact_max completed trips get the exact median speed instead of the histogram one
+    """
+    if speed_edges is None:
+        speed_edges = speed_edges_default
+    n_bins = len(speed_edges) - 1
+    pickup = _to_seconds(df.pickup_datetime)
+    dropoff = _to_seconds(df.dropoff_datetime)
+    speed = trip_speed(df)
+    bins = _speed_bins(speed, speed_edges)
+    zones = pd.to_numeric(df[zone_col], errors = 'coerce').to_numpy(dtype = np.float64)
+
+    counts = {w: np.full(len(df), np.nan) for w in windows}
+    speeds = {w: np.full(len(df), np.nan) for w in windows}
+    valid = np.flatnonzero(np.isfinite(zones))
+    order = valid[np.argsort(zones[valid], kind = 'stable')]
+    _, starts = np.unique(zones[order], return_index = True)
+    for rows in np.split(order, starts[1:]):
+        p = pickup[rows]
+        p_sorted = np.sort(p)
+        by_dropoff = np.argsort(dropoff[rows], kind = 'stable')
+        d_sorted = dropoff[rows][by_dropoff]
+        s_sorted = speed[rows][by_dropoff]
+        # cum_hist[k] is the speed histogram of the first k trips of the zone to be completed
+        cum_hist = np.zeros((len(rows) + 1, n_bins), dtype = np.int32)
+        cum_hist[np.arange(1, len(rows) + 1), bins[rows][by_dropoff]] = 1
+        cum_hist = cum_hist.cumsum(axis = 0)
+
+        end_p = np.searchsorted(p_sorted, p, side = 'left')
+        end_d = np.searchsorted(d_sorted, p, side = 'left')
+        for w in windows:
+            start = p - 60 * w
+            counts[w][rows] = end_p - np.searchsorted(p_sorted, start, side = 'left')
+            start_d = np.searchsorted(d_sorted, start, side = 'left')
+            hist = cum_hist[end_d] - cum_hist[start_d]
+            median = _hist_median(hist, speed_edges)
+            # the trips completed in the window are s_sorted[start_d:end_d]
+            n_done = end_d - start_d
+            small = (n_done > 0) & (n_done <= exact_max)
+            median[small] = _window_medians(s_sorted, start_d[small], n_done[small], exact_max)
+            speeds[w][rows] = median
+
+    for w in windows:
+        df['zone_pickups_'+str(w)+'m'] = counts[w]
+        df['zone_speed_'+str(w)+'m'] = speeds[w]
+    return df
+
+def congestion_stream(windows = (15, 60), speed_edges = None, exact_max = 32):
+    """
+    Creates the state of the streaming mode. Pickups and completed trips are added as they happen with stream_add_pickups and
+    stream_add_dropoffs (in time order) and the current features of any zone are read with stream_features.
+    """
+    if speed_edges is None:
+        speed_edges = speed_edges_default
+    return {'windows': list(windows), 'edges': np.asarray(speed_edges, dtype = np.float64), 'exact_max': exact_max,
+            'zones': {}}
+
+def _stream_zone(state, zone):
+    """
+    Returns the windows of zone, creating them the first time the zone is seen.
+    """
+    if zone not in state['zones']:
+        n_bins = len(state['edges']) - 1
+        state['zones'][zone] = {w: {'pickups': deque(), 'dropoffs': deque(), 'hist': np.zeros(n_bins, dtype = np.int64)}
+                                for w in state['windows']}
+    return state['zones'][zone]
+
+def _stream_evict(window, w, now):
+    """
+    Drops the pickups and dropoffs that are older than w minutes before now from a zone window.
+    """
+    start = now - 60 * w
+    while window['pickups'] and window['pickups'][0] < start:
+        window['pickups'].popleft()
+    while window['dropoffs'] and window['dropoffs'][0][0] < start:
+        window['hist'][window['dropoffs'].popleft()[1]] -= 1
+
+def stream_add_pickups(state, zones, pickup_datetime):
+    """
+    Adds new pickups to the stream.
+    zones: zone of every pickup
+    pickup_datetime: pickup time of every pickup
+    """
+    for zone, t in zip(zones, _to_seconds(pickup_datetime)):
+        for window in _stream_zone(state, zone).values():
+            window['pickups'].append(t)
+
+def stream_add_dropoffs(state, zones, dropoff_datetime, speed):
+    """
+    Adds newly completed trips to the stream.
+    zones: pickup zone of every trip
+    dropoff_datetime: dropoff time of every trip
+    speed: average speed of every trip in mph (see trip_speed)
+    """
+    speed = np.asarray(speed, dtype = np.float64)
+    bins = _speed_bins(speed, state['edges'])
+    for zone, t, b, v in zip(zones, _to_seconds(dropoff_datetime), bins, speed):
+        for window in _stream_zone(state, zone).values():
+            window['dropoffs'].append((t, b, v))
+            window['hist'][b] += 1
+
+def stream_features(state, zones, now):
+    """
+    Returns the current congestion features (same columns as add_congestion_features) of every zone in zones at time now.
+    Pickups and dropoffs at exactly now are counted, so query before adding the events of now to match the batch mode.
+    """
+    now = _to_seconds(pd.Series([now]))[0]
+    features = {}
+    for w in state['windows']:
+        counts, hists, exact = [], [], {}
+        for i, zone in enumerate(zones):
+            window = _stream_zone(state, zone)[w]
+            _stream_evict(window, w, now)
+            counts.append(len(window['pickups']))
+            hists.append(window['hist'])
+            if 0 < len(window['dropoffs']) <= state['exact_max']:
+                exact[i] = np.median([v for _, _, v in window['dropoffs']])
+        median = _hist_median(np.array(hists).reshape(len(zones), len(state['edges']) - 1), state['edges'])
+        median[list(exact)] = list(exact.values())
+        features['zone_pickups_'+str(w)+'m'] = counts
+        features['zone_speed_'+str(w)+'m'] = median
+    return pd.DataFrame(features)
@@ -0,0 +1,119 @@
+"""
+This module contains user defined functions for encoding the categorical and periodic variables for the linear models.
+The one hot encoded variables are built directly as scipy CSR sparse matrices instead of dense dummy columns, and the fourier
+terms of the hour and weekday are gathered from small precomputed tables (24 and 7 rows) using the integer codes of each trip.
+"""
+import pandas as pd
+import numpy as np
+import scipy.sparse as sp
+
+weekdays = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
+
+def fourier_table(period, k):
+    """
+    Returns the period x 2k table of fourier terms [sin1, cos1, sin2, cos2, ...] for every integer value 0 to period-1.
+    """
+    t = np.arange(period)[:, None] * np.arange(1, k+1)[None, :] * 2 * np.pi / period
+    table = np.empty((period, 2*k))
+    table[:, 0::2] = np.sin(t)
+    table[:, 1::2] = np.cos(t)
+    return table
+
+def fourier_names(prefix, k):
+    """
+    Column names matching the columns of fourier_table, e.g. hour_sin1, hour_cos1, hour_sin2, ...
+    """
+    names = []
+    for i in range(1, k+1):
+        names += [prefix+'_sin'+str(i), prefix+'_cos'+str(i)]
+    return names
+
+def _numeric_weekday_codes(weekday):
+    """
+    Integer codes of dayofweek values, -1 for the missing, non integer or out of range (not 0 to 6) values.
+    """
+    values = np.asarray(weekday, dtype = np.float64)
+    valid = np.isfinite(values) & (values >= 0) & (values <= 6) & (values == np.floor(values))
+    return np.where(valid, values, -1).astype(np.int64)
+
+def weekday_codes(weekday):
+    """
+    Converts the pickup_weekday column to integer codes with Monday = 0 and Sunday = 6. Works for the ordered Categorical of day
+    names created by prepare_dataframe, plain day name strings and integer dayofweek values (also as a Categorical).
+    Raises a ValueError if any value is missing or is not one of these forms (e.g. 'monday', 'Mon' or 7), instead of returning
+    the -1 code that would silently be read as Sunday by the lookup tables.
+    """
+    if isinstance(weekday.dtype, pd.api.types.CategoricalDtype):
+        if list(weekday.cat.categories) == weekdays:
+            codes = weekday.cat.codes.to_numpy().astype(np.int64)
+        elif pd.api.types.is_numeric_dtype(weekday.cat.categories):
+            codes = _numeric_weekday_codes(weekday.astype(np.float64))
+        else:
+            codes = pd.Categorical(weekday.astype(object), categories = weekdays).codes.astype(np.int64)
+    elif pd.api.types.is_numeric_dtype(weekday):
+        codes = _numeric_weekday_codes(weekday)
+    else:
+        codes = pd.Categorical(weekday, categories = weekdays).codes.astype(np.int64)
+    if (codes < 0).any():
+        bad = pd.Series(weekday)[codes < 0].astype(object).unique()[:5]
+        raise ValueError("pickup_weekday should be day names (Monday to Sunday) or dayofweek integers (0 to 6), "
+                         "got {}".format(bad.tolist()))
+    return codes
+
+def fourier_terms(df, week_k = 3, day_k = 3):
+    """
+    Returns the dense (rows x 2*(week_k + day_k)) array of fourier terms of the pickup weekday and hour along with the column
+    names. The terms are looked up from the 7 x 2week_k and 24 x 2day_k tables by the weekday and hour codes.
+    """
+    week = fourier_table(7, week_k)[weekday_codes(df.pickup_weekday)]
+    hour = fourier_table(24, day_k)[df.pickup_hour.to_numpy().astype(np.int64)]
+    return np.hstack([week, hour]), fourier_names('week', week_k) + fourier_names('hour', day_k)
+
+def fit_one_hot(df, columns):
+    """
+    Learns the categories of every column in columns (usually from the training set only).
+    Returns a dictionary of {column: array of categories}.
+    """
+    return {col: pd.Categorical(df[col]).categories.to_numpy() for col in columns}
+
+def sparse_one_hot(df, categories, drop_first = True):
+    """
+    One hot encodes the columns in categories as a scipy CSR matrix with one non zero per row and column (so the memory
+    grows with the number of rows, not rows x categories).
+    df: dataframe to encode
+    categories: dictionary returned by fit_one_hot
+    drop_first: same as pd.get_dummies, drops the first category of every column to avoid collinearity in the linear models
+    Values that were not seen in fit_one_hot (and the first category if drop_first) are encoded as all zeros.
+    Returns the CSR matrix and the list of column names, named as pd.get_dummies does (column_category).
+    """
+    n = len(df)
+    rows, cols, names = [], [], []
+    offset = 0
+    for col, cats in categories.items():
+        codes = pd.Categorical(df[col], categories = cats).codes.astype(np.int64)
+        keep = cats[1:] if drop_first else cats
+        if drop_first:
+            codes = codes - 1
+        valid = codes >= 0
+        rows.append(np.flatnonzero(valid))
+        cols.append(codes[valid] + offset)
+        names += [str(col)+'_'+str(cat) for cat in keep]
+        offset += len(keep)
+    rows = np.concatenate(rows) if rows else np.zeros(0, dtype = np.int64)
+    cols = np.concatenate(cols) if cols else np.zeros(0, dtype = np.int64)
+    ohe = sp.csr_matrix((np.ones(len(rows)), (rows, cols)), shape = (n, offset))
+    return ohe, names
+
+def sparse_design_matrix(df, categories, scaler = None, drop_first = True):
+    """
+    Builds the full CSR design matrix for the linear models: the numeric columns of df (all columns not in categories), scaled
+    with the already fitted scaler if given, followed by the sparse one hot columns.
+    Returns the CSR matrix and the list of column names.
+    """
+    num_cols = [col for col in df.columns if col not in categories]
+    numeric = df[num_cols].to_numpy(dtype = np.float64)
+    if scaler is not None:
+        numeric = scaler.transform(numeric)
+    ohe, ohe_names = sparse_one_hot(df, categories, drop_first = drop_first)
+    X = sp.hstack([sp.csr_matrix(numeric), ohe], format = 'csr')
+    return X, num_cols + ohe_names
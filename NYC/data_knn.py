@@ -0,0 +1,97 @@
+"""
+This module contains user defined functions for the historical nearest neighbour trip duration feature. For a trip, the
+median duration of the k past trips with the closest pickup and dropoff points at the same hour of the week is a cheap and
+strong predictor of its duration. The past trips are put in one KD-tree per hour of the week over the 4-D (pickup lat/lon,
+dropoff lat/lon) space, so the neighbours of a batch of trips are found with one tree query per hour instead of scanning
+the whole trip dataframe.
+"""
+import numpy as np
+from scipy.spatial import cKDTree
+from sklearn.model_selection import KFold
+from data_encode import weekday_codes
+
+knn_coord_cols = ['pickup_latitude', 'pickup_longitude', 'dropoff_latitude', 'dropoff_longitude']
+
+def knn_coordinates(df, ref_lat = 40.75):
+    """
+    Returns the (rows x 4) array of pickup and dropoff coordinates used by the KD-trees. The longitudes are multiplied by
+    cos(ref_lat) so that a degree of longitude and latitude are about the same distance around NYC and the euclidean distance
+    in the tree is close to the actual distance between the trips.
+    """
+    coords = np.array(df[knn_coord_cols], dtype = np.float64)
+    coords[:, [1, 3]] *= np.cos(np.radians(ref_lat))
+    return coords
+
+def time_bucket(df, bucket = 'hour_of_week'):
+    """
+    Returns the time bucket of every trip: the hour of the week (0 to 167, Monday 0h is 0) or the hour of the day (0 to 23).
+    """
+    hour = df.pickup_hour.to_numpy().astype(np.int64)
+    if bucket == 'hour_of_week':
+        return weekday_codes(df.pickup_weekday).astype(np.int64) * 24 + hour
+    elif bucket == 'hour':
+        return hour
+    raise ValueError("bucket should be 'hour_of_week' or 'hour', got {}".format(bucket))
+
+def build_knn_index(df, bucket = 'hour_of_week', leafsize = 32):
+    """
+    Builds the nearest neighbour index from the cleaned trips (output of prepare_dataframe, or the training set only when the
+    feature is used for modeling).
+    df: dataframe with the pickup/dropoff coordinates, pickup_hour, pickup_weekday and trip_duration
+    bucket: 'hour_of_week' for one tree per hour of each weekday or 'hour' for one tree per hour of the day
+    Returns a dictionary with the trees and the trip durations of each time bucket.
+    """
+    coords = knn_coordinates(df)
+    durations = df.trip_duration.to_numpy(dtype = np.float64)
+    buckets = time_bucket(df, bucket)
+    order = np.argsort(buckets, kind = 'stable')
+    values, starts = np.unique(buckets[order], return_index = True)
+    index = {'bucket': bucket, 'trees': {}, 'durations': {}}
+    for b, rows in zip(values, np.split(order, starts[1:])):
+        index['trees'][b] = cKDTree(coords[rows], leafsize = leafsize)
+        index['durations'][b] = durations[rows]
+    return index
+
+def query_knn_duration(index, df, k = 10, stat = 'median'):
+    """
+    Returns the median (or mean) duration of the k nearest past trips of every trip in df within the same time bucket.
+    Trips are grouped by time bucket and each group is queried in one batch. If a bucket has less than k trips all of them are
+    used, and trips in a bucket with no past trips get nan.
+    """
+    if stat not in ('median', 'mean'):
+        raise ValueError("stat should be 'median' or 'mean', got {}".format(stat))
+    coords = knn_coordinates(df)
+    buckets = time_bucket(df, index['bucket'])
+    out = np.full(len(df), np.nan)
+    order = np.argsort(buckets, kind = 'stable')
+    values, starts = np.unique(buckets[order], return_index = True)
+    for b, rows in zip(values, np.split(order, starts[1:])):
+        if b not in index['trees']:
+            continue
+        tree, durations = index['trees'][b], index['durations'][b]
+        k_b = min(k, tree.n)
+        _, idx = tree.query(coords[rows], k = k_b)
+        neighbours = durations[idx.reshape(len(rows), k_b)]
+        out[rows] = np.median(neighbours, axis = 1) if stat == 'median' else neighbours.mean(axis = 1)
+    return out
+
+def add_knn_duration(df, index, k = 10, col = 'knn_duration'):
+    """
+    Adds the nearest neighbour duration column col to df (for the test set or new trips, with an index built on the
+    training set).
+    """
+    df[col] = query_knn_duration(index, df, k = k)
+    return df
+
+def oof_knn_duration(df, k = 10, n_folds = 5, bucket = 'hour_of_week', random_state = 42):
+    """
+    Out of fold nearest neighbour durations for the training set: the trips of every fold are queried against an index built
+    on the other folds only, so a trip never finds itself (or its own duration) among its neighbours.
+    Returns the array of durations in the order of df.
+    """
+    out = np.full(len(df), np.nan)
+    kf = KFold(n_splits = n_folds, shuffle = True, random_state = random_state)
+    for fit_idx, query_idx in kf.split(np.zeros(len(df))):
+        index = build_knn_index(df.iloc[fit_idx], bucket = bucket)
+        out[query_idx] = query_knn_duration(index, df.iloc[query_idx], k = k)
+    return out
@@ -0,0 +1,119 @@
+"""
+This module contains user defined functions for removing the outlier trips. Every rule is evaluated on the numpy arrays of the
+columns it needs and sets its own bit in a small per row bitmask, so all the rules run in one pass without copying the dataframe
+and the mask tells exactly which rules rejected every trip. outlier_report turns the mask into the per rule rejection counts.
+"""
+import pandas as pd
+import numpy as np
+
+# The rules in the order of their bit in the outlier mask
+outlier_rule_names = ['min_duration', 'max_duration', 'pickup_bbox', 'dropoff_bbox', 'zero_distance', 'max_distance',
+                      'max_speed', 'zone_hour_duration']
+
+# Same limits as the ones hard coded in prepare_dataframe before, the implied speed and zone/hour rules are off by default
+outlier_rules_default = {'min_duration': 60,
+                         'max_duration_pct': 99.8,
+                         'long_limits': (-74.257159, -73.699215),
+                         'lat_limits': (40.471021, 40.987326),
+                         'zero_distance': True,
+                         'max_distance_pct': 99.8,
+                         'max_speed': None,
+                         'zone_hour_stats': None}
+
+def zone_hour_duration_stats(df, zone_col = 'pickup_taxizone_id', quantiles = (0.005, 0.995), min_trips = 30):
+    """
+    Precomputes the robust trip duration limits of every (zone, hour of the day) pair for the zone_hour_duration rule.
+    df: trips with the zone column (assign_taxi_zones), pickup_hour and trip_duration
+    quantiles: the trips of a zone and hour with a duration outside these quantiles are rejected. The limits are observed
+               durations (the quantiles are rounded outwards, not interpolated), so a group rejects at most its nominal share
+               of trips: groups with less than 1/quantiles[0] (200) trips keep their own minimum and maximum.
+    min_trips: zone/hour pairs with less trips than this get no limits (nothing is rejected there)
+    Returns a dictionary with the zone column name and the (266 zones x 24 hours) arrays of low and high limits.
+    """
+    grouped = df.groupby([zone_col, 'pickup_hour']).trip_duration
+    limits = pd.DataFrame({'low': grouped.quantile(quantiles[0], interpolation = 'lower'),
+                           'high': grouped.quantile(quantiles[1], interpolation = 'higher')})
+    counts = grouped.size()
+    limits = limits[counts.reindex(limits.index) >= min_trips]
+    low, high = np.full((266, 24), np.nan), np.full((266, 24), np.nan)
+    zones = limits.index.get_level_values(0).astype(np.int64)
+    hours = limits.index.get_level_values(1).astype(np.int64)
+    low[zones, hours] = limits['low'].to_numpy()
+    high[zones, hours] = limits['high'].to_numpy()
+    return {'zone_col': zone_col, 'low': low, 'high': high}
+
+def outlier_mask(df, rules = None):
+    """
+    Evaluates all the outlier rules and returns the uint16 bitmask of every row (0 means the row is kept, bit i is set if the
+    rule outlier_rule_names[i] rejected it).
+    rules: dictionary overriding any of the outlier_rules_default values. Set a rule's value to None to switch it off.
+    Every rule states the condition a row has to meet to be kept, so rows with a nan in the columns of a rule are rejected by
+    it, and the percentiles are computed without the nan values.
+    min_duration: trips of min_duration seconds or less are rejected
+    max_duration_pct: trips longer than this percentile of trip_duration are rejected
+    long_limits, lat_limits: pickup and dropoff points have to be within these (min, max) boundaries
+    zero_distance: if True trips with a haversine distance of 0 are rejected
+    max_distance_pct: trips with a haversine distance of more than this percentile of distance_hav are rejected
+    max_speed: trips with an implied speed (distance_hav over trip_duration) above max_speed mph are rejected
+    zone_hour_stats: output of zone_hour_duration_stats, trips outside the duration limits of their zone and hour are rejected
+    """
+    config = dict(outlier_rules_default)
+    if rules is not None:
+        config.update(rules)
+    duration = df.trip_duration.to_numpy(dtype = np.float64)
+    distance = df.distance_hav.to_numpy(dtype = np.float64)
+    mask = np.zeros(len(df), dtype = np.uint16)
+
+    def flag(rule, rejected):
+        mask[rejected] |= np.uint16(1 << outlier_rule_names.index(rule))
+
+    if config['min_duration'] is not None:
+        flag('min_duration', ~(duration > config['min_duration']))
+    if config['max_duration_pct'] is not None:
+        flag('max_duration', ~(duration <= np.nanpercentile(duration, config['max_duration_pct'])))
+    if config['long_limits'] is not None and config['lat_limits'] is not None:
+        (lon_min, lon_max), (lat_min, lat_max) = config['long_limits'], config['lat_limits']
+        for rule, point in [('pickup_bbox', 'pickup'), ('dropoff_bbox', 'dropoff')]:
+            lon = df[point+'_longitude'].to_numpy(dtype = np.float64)
+            lat = df[point+'_latitude'].to_numpy(dtype = np.float64)
+            flag(rule, ~((lon >= lon_min) & (lon <= lon_max) & (lat >= lat_min) & (lat <= lat_max)))
+    if config['zero_distance']:
+        flag('zero_distance', ~(distance > 0))
+    if config['max_distance_pct'] is not None:
+        flag('max_distance', ~(distance <= np.nanpercentile(distance, config['max_distance_pct'])))
+    if config['max_speed'] is not None:
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            flag('max_speed', ~(distance / (duration / 3600) <= config['max_speed']))
+    if config['zone_hour_stats'] is not None:
+        stats = config['zone_hour_stats']
+        zone = pd.to_numeric(df[stats['zone_col']], errors = 'coerce').to_numpy(dtype = np.float64)
+        hour = df.pickup_hour.to_numpy().astype(np.int64)
+        known = np.isfinite(zone) & (zone >= 0) & (zone < stats['low'].shape[0])
+        zone = np.where(known, zone, 0).astype(np.int64)
+        # comparisons with the nan limits of unknown zones or small zone/hour groups are False, so nothing is rejected there
+        with np.errstate(invalid = 'ignore'):
+            flag('zone_hour_duration', (duration < stats['low'][zone, hour]) | (duration > stats['high'][zone, hour]))
+    return mask
+
+def outlier_report(mask):
+    """
+    Summarizes the outlier mask: for every rule the number of rows it rejected and the number of rows rejected by that rule
+    only, plus a 'total' row with the overall number of rejected rows (and of rows rejected by a single rule).
+    """
+    bits = (mask[:, None] >> np.arange(len(outlier_rule_names), dtype = np.uint16)) & 1
+    only = bits.sum(axis = 1) == 1
+    report = pd.DataFrame({'rule': outlier_rule_names,
+                           'rejected': bits.sum(axis = 0).astype(np.int64),
+                           'rejected_only': bits[only].sum(axis = 0).astype(np.int64)})
+    total = pd.DataFrame({'rule': ['total'], 'rejected': [int((mask > 0).sum())], 'rejected_only': [int(only.sum())]})
+    report = pd.concat([report, total], ignore_index = True)
+    report['pct_rows'] = 100. * report.rejected / max(len(mask), 1)
+    return report
+
+def filter_outliers(df, rules = None):
+    """
+    Removes the outlier rows of df with the rules of outlier_mask.
+    Returns the filtered dataframe and the outlier_report.
+    """
+    mask = outlier_mask(df, rules)
+    return df[mask == 0], outlier_report(mask)
@@ -8,6 +8,7 @@ import requests
 import json
 from lxml import html
 import math
+from data_outliers import *
 
 """
 This module contains user defined functions for importing and cleaning the data and also for adding new features.
@@ -69,7 +70,7 @@ def haversine(coord1, coord2):
     
     If you want to use the more accurate geopy.geodesic function then simply import the function as, 
     -- from geopy.distance import geodesic
-    and use it in the prepare_dataframe function below instead of the haversine function.
+    and use it in the add_trip_features function below instead of the haversine_np function.
     """
     R = 6372800  # Earth radius in meters
     lat1, lon1 = coord1
@@ -84,33 +85,30 @@ def haversine(coord1, coord2):
     # returning distance in miles (so converting meters to miles)
     return 0.000621371*2*R*math.atan2(math.sqrt(a), math.sqrt(1 - a))
 
-def prepare_dataframe(raw_df = None, nyc_long_limits = (-74.257159, -73.699215), nyc_lat_limits = (40.471021, 40.987326)):
-
-    # Verifying the correct pickup and dropoff datetime columns
-    if 'pickup_datetime' and 'dropoff_datetime' not in raw_df:
-        raw_df = raw_df.rename(columns={'tpep_pickup_datetime': "pickup_datetime", 
-                                          'tpep_dropoff_datetime': "dropoff_datetime"})
-     
-    # Calculating the y variable which is trip duration in seconds
-    if 'trip_duration' not in raw_df:
-        raw_df['trip_duration'] = (raw_df['dropoff_datetime'] - raw_df['pickup_datetime'])/np.timedelta64(1,'s')
-        
-    cols = ['vendorid', 'pickup_datetime', 'dropoff_datetime',
-       'passenger_count', 'pickup_longitude', 'pickup_latitude', 'store_and_fwd_flag',
-       'dropoff_longitude', 'dropoff_latitude', 'trip_duration']
-    
-    df = raw_df[cols]
+def haversine_np(lat1, lon1, lat2, lon2):
+    """
+    Vectorized version of the haversine function above, takes arrays of pickup and dropoff lats and lons and returns the
+    array of distances in miles.
+    """
+    R = 6372800  # Earth radius in meters
+    phi1, phi2 = np.radians(lat1), np.radians(lat2)
+    dphi       = np.radians(lat2 - lat1)
+    dlambda    = np.radians(lon2 - lon1)
     
-    # Check for NULL values
-    if df.isnull().sum().sum() !=0:
-        print("There are NULL values in the dataset. You'll have take of the null values separately, this function doesn't deal \
-              with Null value")
+    a = np.sin(dphi/2)**2 + np.cos(phi1)*np.cos(phi2)*np.sin(dlambda/2)**2
+    return 0.000621371*2*R*np.arctan2(np.sqrt(a), np.sqrt(1 - a))
+
+def add_trip_features(df):
+    """
+    Adds the datetime, holiday and haversine distance columns that only need the pickup time and the pickup and dropoff 
+    locations. Used by prepare_dataframe for the training data and by score_trips for the trips to be scored.
+    """
     # Adding extra datetime columns 
     df['pickup_date'] = pd.to_datetime(df.pickup_datetime.dt.date)
     df['pickup_month'] = df.pickup_datetime.dt.month
     df['pickup_day'] = df.pickup_datetime.dt.day  
     df['pickup_hour'] = df.pickup_datetime.dt.hour
-    df['pickup_weekday'] = df.pickup_datetime.dt.weekday_name
+    df['pickup_weekday'] = df.pickup_datetime.dt.day_name()
     df["vendorid"] = df["vendorid"].astype('category')
     
     #cats = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
@@ -125,21 +123,62 @@ def prepare_dataframe(raw_df = None, nyc_long_limits = (-74.257159, -73.699215),
     df['holiday'] = 1*pd.to_datetime(df.pickup_datetime.dt.date).isin(holidays) 
 
     # ADD haversine distance
-    df['distance_hav'] = df.apply(lambda x: haversine((x['pickup_latitude'], x['pickup_longitude']), 
-                                   (x['dropoff_latitude'], x['dropoff_longitude'])), axis = 1)
+    df['distance_hav'] = haversine_np(df.pickup_latitude.to_numpy(), df.pickup_longitude.to_numpy(),
+                                      df.dropoff_latitude.to_numpy(), df.dropoff_longitude.to_numpy())
+    
+    return df
+
+def prepare_dataframe(raw_df = None, nyc_long_limits = (-74.257159, -73.699215), nyc_lat_limits = (40.471021, 40.987326),
+                      outlier_rules = None, report = False):
+    """
+    Adds the trip duration, datetime, holiday and haversine distance columns to the raw trips and removes the outliers.
+    nyc_long_limits, nyc_lat_limits: pickup and dropoff points outside these boundaries are removed
+    outlier_rules: dictionary overriding the other outlier rules of outlier_mask (duration and distance percentiles, implied
+                   speed, ...). The zone_hour_stats rule needs the zone column, which the raw trips usually don't have: raw_df
+                   must then already contain it (the zone columns are kept), otherwise use filter_outliers on the output of
+                   assign_taxi_zones instead.
+    report: if True, the outlier_report with the number of trips rejected by every rule is returned along with the dataframe
+    """
+
+    # Verifying the correct pickup and dropoff datetime columns
+    if 'pickup_datetime' and 'dropoff_datetime' not in raw_df:
+        raw_df = raw_df.rename(columns={'tpep_pickup_datetime': "pickup_datetime", 
+                                          'tpep_dropoff_datetime': "dropoff_datetime"})
+     
+    # Calculating the y variable which is trip duration in seconds
+    if 'trip_duration' not in raw_df:
+        raw_df['trip_duration'] = (raw_df['dropoff_datetime'] - raw_df['pickup_datetime'])/np.timedelta64(1,'s')
+        
+    cols = ['vendorid', 'pickup_datetime', 'dropoff_datetime',
+       'passenger_count', 'pickup_longitude', 'pickup_latitude', 'store_and_fwd_flag',
+       'dropoff_longitude', 'dropoff_latitude', 'trip_duration']
+    
+    # Keeping the zone columns if the zones were already assigned, the zone/hour duration rule needs them
+    cols = cols + [col for col in ['pickup_taxizone_id', 'dropoff_taxizone_id'] if col in raw_df]
+    zone_stats = (outlier_rules or {}).get('zone_hour_stats')
+    if zone_stats is not None and zone_stats['zone_col'] not in raw_df:
+        raise ValueError("The zone_hour_stats rule needs the {} column, assign the zones first (assign_taxi_zones) or "
+                         "call filter_outliers after assign_taxi_zones".format(zone_stats['zone_col']))
+    
+    df = raw_df[cols]
+    
+    # Check for NULL values
+    if df.isnull().sum().sum() !=0:
+        print("There are NULL values in the dataset. You'll have take of the null values separately, this function doesn't deal \
+              with Null value")
+    df = add_trip_features(df)
     
     # REMOVING OUTLIERS
     
     # Since passenger count cannot be 0, assume the most common value (which is 1 for the NYC taxi dataset)
     df.loc[df.passenger_count == 0, 'passenger_count'] = df.passenger_count.value_counts().idxmax()
-    df = df[(df.trip_duration > 60) & (df.trip_duration <= np.percentile(df.trip_duration, 99.8))
-                   & (df.pickup_longitude.between(nyc_long_limits[0], nyc_long_limits[1]))
-                   & (df.dropoff_longitude.between(nyc_long_limits[0], nyc_long_limits[1]))
-                   & (df.pickup_latitude.between(nyc_lat_limits[0], nyc_lat_limits[1]))
-                   & (df.dropoff_latitude.between(nyc_lat_limits[0], nyc_lat_limits[1]))
-                   & (df.distance_hav > 0)
-                   & (df.distance_hav <= np.percentile(df.distance_hav, 99.8))]
+    rules = {'long_limits': nyc_long_limits, 'lat_limits': nyc_lat_limits}
+    if outlier_rules is not None:
+        rules.update(outlier_rules)
+    df, outliers = filter_outliers(df, rules)
     
+    if report:
+        return(df, outliers)
     return(df)
 
 def bearing(coordinates):
@@ -3,6 +3,8 @@
 from nyc_ml_err_plots import *
 from sklearn.model_selection import train_test_split
 from sklearn.preprocessing import StandardScaler
+from data_encode import *
+from data_target_encode import *
 
 def add_fourier_terms(df, week_k = 3, day_k = 3):
     """
@@ -14,30 +16,31 @@ def add_fourier_terms(df, week_k = 3, day_k = 3):
     week_k: the number of Fourier terms the weekly period should have. Thus the model will be fit on 2*week_k terms \
             (1 term for sine and 1 for cosine)
     day_k:same as week_k but for daily periods
+    pickup_weekday can either be the Categorical of day names from prepare_dataframe or the integer dayofweek (Monday = 0).
     """
 
-    for k in range(1, week_k+1):
-        
-        # week has a period of 7
-        df['week_sin'+str(k)] = np.sin(2 *k* np.pi * df.pickup_weekday/7)
-        df['week_cos'+str(k)] = np.cos(2 *k* np.pi * df.pickup_weekday/7)
-
-
-    for k in range(1, day_k+1):
-        
-        # day has period of 24
-        df['hour_sin'+str(k)] = np.sin(2 *k* np.pi * df.pickup_hour/24)
-        df['hour_cos'+str(k)] = np.cos(2 *k* np.pi * df.pickup_hour/24)
+    # The terms are gathered from the 7 x 2week_k and 24 x 2day_k lookup tables instead of computing sin/cos for every row
+    terms, names = fourier_terms(df, week_k = week_k, day_k = day_k)
+    for i, name in enumerate(names):
+        df[name] = terms[:, i]
         
     #df = df.drop(['pickup_weekday', 'pickup_hour'], axis = 1)
     return df
     
-def prep_train_test(raw_df, test_size = 0.3, fourier = False, scale = False):
+def prep_train_test(raw_df, test_size = 0.3, fourier = False, scale = False, sparse_ohe = None, target_encode = None):
     """
     Function to split the data into train and test sets. 
     raw_df: dataframe to split into train and test sets
     test_size: portion of the raw_df to be used for testing
     fourier: if true, the hour and weekday terms will be transformed into continuous variables using fouier transformation.
+    scale: if true, the X variables are scaled using the StandardScaler fitted on the training set (only the numeric variables
+           if sparse_ohe is used).
+    sparse_ohe: list of categorical columns to one hot encode (drop_first) as sparse columns. If given, X_train and X_test are
+                returned as scipy CSR matrices that can be passed straight to ElasticNet, the categories are learnt from the
+                training set only.
+    target_encode: True or a dictionary of {new column name: list of key columns} (see add_target_encodings) to add the
+                   smoothed mean trip duration of the zone, zone pair and zone x hour keys. The training set gets out of fold
+                   encodings and the test set is encoded with the whole training set.
     """
     #df = raw_df[cols_to_use]
     df = raw_df.copy()
@@ -51,11 +54,23 @@ def prep_train_test(raw_df, test_size = 0.3, fourier = False, scale = False):
                                                     y, test_size = test_size, 
                                                     random_state = 42)
     
+    if target_encode:
+        encodings = None if target_encode is True else target_encode
+        X_train, X_test = add_target_encodings(X_train, y_train, X_test, encodings = encodings)
+        
     if fourier:
         X_train.drop(['pickup_weekday', 'pickup_hour'], axis = 1, inplace = True)
         X_test.drop(['pickup_weekday', 'pickup_hour'], axis = 1, inplace = True)
         
-    if scale:
+    if sparse_ohe:
+        categories = fit_one_hot(X_train, sparse_ohe)
+        scaler = None
+        if scale:
+            num_cols = [col for col in X_train.columns if col not in categories]
+            scaler = StandardScaler().fit(X_train[num_cols].to_numpy(dtype = np.float64))
+        X_train, _ = sparse_design_matrix(X_train, categories, scaler = scaler)
+        X_test, _ = sparse_design_matrix(X_test, categories, scaler = scaler)
+    elif scale:
         scaler = StandardScaler()
         X_train = scaler.fit_transform(X_train)
         X_test = scaler.transform(X_test)
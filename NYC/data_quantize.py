@@ -0,0 +1,92 @@
+"""
+This module contains user defined functions for quantizing the training data once so that it can be reused by the hyperparameter
+search. The features are binned into at most max_bin quantile bins (stored as small integer codes), the cross validation folds are
+kept as index subsets of that single binned matrix and the per fold matrices handed to XGBoost and RandomForest are built only
+once and cached, so every search candidate after the first one starts training straight away.
+"""
+import pandas as pd
+import numpy as np
+import xgboost as xgb
+from sklearn.model_selection import KFold
+
+def quantile_bin_edges(X, max_bin = 256, sample_size = 200000, random_state = 42):
+    """
+    Computes the bin edges of every column of X. Columns with less than max_bin unique values get one bin per value, the others
+    get max_bin - 1 quantile bins (code 0 is kept for missing values).
+    sample_size: the quantiles are computed on a random sample of at most sample_size rows, which is enough for 256 bins and
+                 avoids sorting every column of a multi-million row training set.
+    Returns a list with the array of edges for every column.
+    """
+    X = np.asarray(X, dtype = np.float64)
+    if len(X) > sample_size:
+        rng = np.random.RandomState(random_state)
+        X = X[rng.choice(len(X), sample_size, replace = False)]
+    edges = []
+    for j in range(X.shape[1]):
+        col = X[:, j]
+        col = col[~np.isnan(col)]
+        unique = np.unique(col)
+        if len(unique) < max_bin:
+            edges.append(unique)
+        else:
+            edges.append(np.unique(np.quantile(col, np.linspace(0, 1, max_bin))[:-1]))
+    return edges
+
+def apply_bin_edges(X, edges):
+    """
+    Converts X to the integer bin codes of edges (uint8 when all codes fit, uint16 otherwise). Missing values get code 0 and a
+    value v gets the code of the last edge <= v, starting from 1.
+    """
+    X = np.asarray(X, dtype = np.float64)
+    dtype = np.uint8 if max(len(e) for e in edges) < 256 else np.uint16
+    codes = np.empty(X.shape, dtype = dtype)
+    for j, e in enumerate(edges):
+        col = X[:, j]
+        code = np.maximum(np.searchsorted(e, col, side = 'right'), 1)
+        code[np.isnan(col)] = 0
+        codes[:, j] = code
+    return codes
+
+def quantized_training_data(X_train, y_train, n_folds = 3, max_bin = 256):
+    """
+    Quantizes X_train once and defines the cross validation folds as index subsets of it.
+    X_train: training dataframe (numeric columns only) or array
+    y_train: training target
+    n_folds: number of folds, split the same way as RandomizedSearchCV(cv = n_folds) does for regressors (KFold, no shuffle)
+    Returns a dictionary holding the binned codes, the bin edges, y, the folds and the caches for the per fold model inputs.
+    Pass the same dictionary to cv_optimize_quantized for every model/parameter search on this training set.
+    """
+    columns = list(X_train.columns) if isinstance(X_train, pd.DataFrame) else None
+    edges = quantile_bin_edges(X_train, max_bin = max_bin)
+    data = {'codes': apply_bin_edges(X_train, edges),
+            'edges': edges,
+            'columns': columns,
+            'y': np.asarray(y_train, dtype = np.float64),
+            'folds': list(KFold(n_splits = n_folds).split(np.zeros(len(y_train)))),
+            'max_bin': max_bin,
+            'cache': {}}
+    return data
+
+def xgb_fold_matrices(data):
+    """
+    Returns the (train, validation) xgboost DMatrix pairs for every fold. They are sliced out of a single DMatrix of the binned
+    codes on the first call and cached in data, and since the same DMatrix objects are reused for every candidate XGBoost keeps
+    its histogram index built on the first fit instead of recomputing it.
+    """
+    if 'xgb' not in data['cache']:
+        dall = xgb.DMatrix(data['codes'], label = data['y'], feature_names = data['columns'])
+        data['cache']['xgb'] = [(dall.slice(train_idx), dall.slice(valid_idx)) for train_idx, valid_idx in data['folds']]
+    return data['cache']['xgb']
+
+def rf_fold_arrays(data):
+    """
+    Returns the (X train, y train, X validation, y validation) arrays of the binned codes for every fold, as float32 so that
+    the sklearn trees can use them without another copy. Built once and cached in data.
+    """
+    if 'rf' not in data['cache']:
+        folds = []
+        for train_idx, valid_idx in data['folds']:
+            folds.append((np.ascontiguousarray(data['codes'][train_idx], dtype = np.float32), data['y'][train_idx],
+                          np.ascontiguousarray(data['codes'][valid_idx], dtype = np.float32), data['y'][valid_idx]))
+        data['cache']['rf'] = folds
+    return data['cache']['rf']
@@ -0,0 +1,105 @@
+"""
+This module contains user defined functions for the target encoding of the zone and time variables. Instead of feeding the
+263 zone ids (or the ~70k zone pairs) to the models, every key is replaced by the smoothed mean trip duration of the training
+trips with the same key. The keys are turned into integer codes and all the group sums and counts are done with np.bincount,
+so the encodings of tens of millions of trips take seconds.
+
+To avoid leaking the target, the training set gets out of fold encodings (every trip is encoded with the statistics of the
+other folds only) and the test set is encoded with the statistics of the whole training set.
+"""
+import pandas as pd
+import numpy as np
+from sklearn.model_selection import KFold
+from data_encode import weekday_codes
+
+# Number of integer codes of every key column. Zone ids go from 1 to 265, code 0 is used for the missing/unknown values.
+key_sizes = {'pickup_taxizone_id': 266, 'dropoff_taxizone_id': 266, 'pickup_hour': 24, 'pickup_weekday': 7,
+             'pickup_month': 13, 'pickup_day': 32}
+
+# Encoded column name: key columns
+target_encodings_default = {'pickup_zone_te': ['pickup_taxizone_id'],
+                            'dropoff_zone_te': ['dropoff_taxizone_id'],
+                            'zone_pair_te': ['pickup_taxizone_id', 'dropoff_taxizone_id'],
+                            'pickup_zone_hour_te': ['pickup_taxizone_id', 'pickup_hour'],
+                            'dropoff_zone_hour_te': ['dropoff_taxizone_id', 'pickup_hour']}
+
+def key_codes(df, cols):
+    """
+    Combines the key columns cols of df into one integer code per row (mixed radix with the sizes of key_sizes).
+    Returns the codes and the number of possible codes. Missing or out of range values of a column get its code 0, except
+    for pickup_weekday where weekday_codes raises a ValueError.
+    """
+    codes = np.zeros(len(df), dtype = np.int64)
+    n_codes = 1
+    for col in cols:
+        size = key_sizes[col]
+        if col == 'pickup_weekday':
+            values = weekday_codes(df[col]).astype(np.float64)
+        else:
+            values = pd.to_numeric(df[col], errors = 'coerce').to_numpy(dtype = np.float64)
+        values = np.where(np.isfinite(values) & (values >= 0) & (values < size), values, 0).astype(np.int64)
+        codes = codes * size + values
+        n_codes *= size
+    return codes, n_codes
+
+def _group_stats(codes, y, n_codes):
+    """
+    Returns the sum of y and the number of rows for every code.
+    """
+    return np.bincount(codes, weights = y, minlength = n_codes), np.bincount(codes, minlength = n_codes)
+
+def _smoothed_mean(sums, counts, prior, smoothing):
+    """
+    Mean of every group shrunk towards the prior: groups with few trips get close to the prior.
+    """
+    return (sums + smoothing * prior) / (counts + smoothing)
+
+def oof_target_encoding(codes, y, n_codes, smoothing = 20, n_folds = 5, random_state = 42):
+    """
+    Out of fold encodings of the training codes. The group sums of every fold are computed once and the statistics of the
+    other folds are obtained by subtracting them from the totals, so the cost doesn't grow with n_folds.
+    """
+    total_sums, total_counts = _group_stats(codes, y, n_codes)
+    out = np.empty(len(codes))
+    kf = KFold(n_splits = n_folds, shuffle = True, random_state = random_state)
+    for fit_idx, enc_idx in kf.split(codes):
+        fold_sums, fold_counts = _group_stats(codes[enc_idx], y[enc_idx], n_codes)
+        sums, counts = total_sums - fold_sums, total_counts - fold_counts
+        prior = y[fit_idx].mean()
+        c = codes[enc_idx]
+        out[enc_idx] = _smoothed_mean(sums[c], counts[c], prior, smoothing)
+    return out
+
+def fit_target_encoding(codes, y, n_codes, smoothing = 20):
+    """
+    Returns the table of smoothed means (one value per code) computed on all the training rows, to encode new trips with.
+    """
+    sums, counts = _group_stats(codes, y, n_codes)
+    return _smoothed_mean(sums, counts, y.mean(), smoothing)
+
+def add_target_encodings(X_train, y_train, X_test = None, encodings = None, smoothing = 20, n_folds = 5, log_target = False):
+    """
+    Adds the target encoded columns to the training (out of fold) and test sets.
+    X_train, y_train: training set and trip durations
+    X_test: test set or new trips, encoded with the statistics of the whole training set
+    encodings: dictionary of {new column name: list of key columns}. default: target_encodings_default
+    smoothing: weight of the global mean, in number of trips, in every group mean
+    n_folds: number of folds of the out of fold training encodings
+    log_target: if True the encodings are the means of log(1 + trip_duration) instead of the trip duration
+    Returns X_train and X_test with the new columns (X_test is None if not given).
+    """
+    if encodings is None:
+        encodings = target_encodings_default
+    y = np.asarray(y_train, dtype = np.float64)
+    if log_target:
+        y = np.log1p(y)
+    X_train = X_train.copy()
+    if X_test is not None:
+        X_test = X_test.copy()
+    for name, cols in encodings.items():
+        codes, n_codes = key_codes(X_train, cols)
+        X_train[name] = oof_target_encoding(codes, y, n_codes, smoothing = smoothing, n_folds = n_folds)
+        if X_test is not None:
+            table = fit_target_encoding(codes, y, n_codes, smoothing = smoothing)
+            X_test[name] = table[key_codes(X_test, cols)[0]]
+    return X_train, X_test
@@ -0,0 +1,152 @@
+"""
+This module contains user defined functions for precomputing the zone to zone travel matrix from the taxi zones shape file.
+The straight line haversine distance ignores the rivers and bridges that NYC trips have to go around, so instead the taxi zones
+are turned into a graph (zones sharing a border are neighbours, plus the bridges and tunnels crossing the water listed below),
+the shortest paths between the zone centroids are computed once for all the zone pairs and stored as a small matrix.
+Adding the features to the trips is then just a lookup on the (pickup zone, dropoff zone) pair.
+"""
+import pandas as pd
+import numpy as np
+import geopandas as gpd
+import scipy.sparse as sp
+from scipy.sparse.csgraph import shortest_path
+
+# Bridges, tunnels and ferries joining zones that don't share a border in the shape file, as (LocationID, LocationID) pairs.
+water_crossings = [
+    (231, 65),   # Brooklyn Bridge: TriBeCa/Civic Center - Downtown Brooklyn
+    (232, 66),   # Manhattan Bridge: Two Bridges - DUMBO
+    (148, 256),  # Williamsburg Bridge: Lower East Side - Williamsburg (South Side)
+    (88, 195),   # Brooklyn Battery Tunnel: Financial District South - Red Hook
+    (229, 146),  # Queensboro Bridge: Sutton Place - Long Island City/Queens Plaza
+    (233, 145),  # Queens Midtown Tunnel: UN/Turtle Bay South - Long Island City/Hunters Point
+    (202, 193),  # Roosevelt Island Bridge: Roosevelt Island - Queensbridge/Ravenswood
+    (74, 194),   # RFK Bridge: East Harlem North - Randalls Island
+    (194, 8),    # RFK Bridge: Randalls Island - Astoria Park
+    (194, 168),  # RFK Bridge: Randalls Island - Mott Haven/Port Morris
+    (252, 208),  # Whitestone Bridge: Whitestone - Schuylerville/Edgewater Park
+    (15, 208),   # Throgs Neck Bridge: Bay Terrace/Fort Totten - Schuylerville/Edgewater Park
+    (14, 6),     # Verrazzano Bridge: Bay Ridge - Arrochar/Fort Wadsworth
+    (154, 27),   # Marine Parkway Bridge: Marine Park/Floyd Bennett Field - Breezy Point
+    (124, 30),   # Cross Bay Bridge: Howard Beach - Broad Channel
+    (30, 117),   # Cross Bay Bridge: Broad Channel - Hammels/Arverne
+    (46, 184),   # City Island Bridge: City Island - Pelham Bay Park
+    (74, 168),   # Willis Avenue and Third Avenue Bridges: East Harlem North - Mott Haven/Port Morris
+    (42, 247),   # Madison Avenue, 145th Street and Macombs Dam Bridges: Central Harlem North - West Concourse
+    (120, 119),  # Alexander Hamilton Bridge: Highbridge Park - Highbridge
+    (243, 235),  # Washington Bridge: Washington Heights North - University Heights/Morris Heights
+    (127, 235),  # University Heights Bridge: Inwood - University Heights/Morris Heights
+    (112, 145),  # Pulaski Bridge: Greenpoint - Long Island City/Hunters Point
+    (112, 226),  # Greenpoint Avenue Bridge: Greenpoint - Sunnyside (Blissville)
+    (80, 226),   # Kosciuszko Bridge: East Williamsburg - Sunnyside (Maspeth side)
+    (223, 199),  # Rikers Island Bridge: Steinway - Rikers Island
+    (12, 105),   # Ferry: Battery Park - Governor's Island
+    (12, 103),   # Ferry: Battery Park - Liberty Island
+    (103, 104),  # Ferry: Liberty Island - Ellis Island
+    (125, 1),    # Holland Tunnel: Hudson Sq - Newark Airport
+    (246, 1),    # Lincoln Tunnel: West Chelsea/Hudson Yards - Newark Airport
+    (23, 1),     # Goethals Bridge: Bloomfield/Emerson Hill - Newark Airport
+]
+
+# Zones whose polygons touch in the shape file although no road joins them, removed from the graph
+false_borders = [
+    (138, 199),  # LaGuardia Airport - Rikers Island (the island is only reached by the Rikers Island Bridge)
+]
+
+# Zone ids go from 1 to 265 in taxi+_zone_lookup.csv, the matrices are indexed directly by the zone id
+n_zone_ids = 266
+
+def zone_graph(shp_path = '../data/external/taxi_zones_shape/taxi_zones.shp', crossings = None, snap = 100):
+    """
+    Builds the zone adjacency graph from the taxi zones shape file (minus the false_borders).
+    shp_path: path of taxi_zones.shp
+    crossings: list of (LocationID, LocationID) pairs to connect on top of the shared borders. default: water_crossings
+    snap: zones closer than snap feet are considered neighbours, to close the small gaps between the zone polygons
+    Returns the sparse (n_zone_ids x n_zone_ids) matrix of centroid to centroid distances in miles between neighbouring zones
+    and the zone centroids dataframe (LocationID, x, y in feet).
+    """
+    if crossings is None:
+        crossings = water_crossings
+    # NY state plane (feet), the shape file's own crs
+    shape_df = gpd.read_file(shp_path).to_crs(epsg = 2263)
+    # the shape file labels the polygons of zones 57 (Corona) and 104, 105 (Ellis Island, Governor's Island) as 56 and 103,
+    # OBJECTID is the zone id of taxi+_zone_lookup.csv for all the rows
+    shape_df['LocationID'] = shape_df.OBJECTID
+    shape_df = shape_df[['LocationID', 'geometry']].dissolve(by = 'LocationID').reset_index()
+
+    centroids = shape_df.geometry.centroid
+    zones = pd.DataFrame({'LocationID': shape_df.LocationID.astype(np.int64), 'x': centroids.x, 'y': centroids.y})
+
+    geoms = shape_df.geometry.buffer(snap / 2.)
+    pairs = []
+    for i, geom in enumerate(geoms):
+        neighbours = np.flatnonzero(geoms.intersects(geom).to_numpy())
+        pairs += [(zones.LocationID[i], zones.LocationID[j]) for j in neighbours if j > i]
+    excluded = set(false_borders) | {(b, a) for a, b in false_borders}
+    pairs = [pair for pair in pairs if pair not in excluded] + list(crossings)
+
+    pairs = np.array(pairs, dtype = np.int64)
+    xy = np.full((n_zone_ids, 2), np.nan)
+    xy[zones.LocationID] = zones[['x', 'y']].to_numpy()
+    # feet to miles
+    dist = np.hypot(*(xy[pairs[:, 0]] - xy[pairs[:, 1]]).T) / 5280
+    graph = sp.coo_matrix((dist, (pairs[:, 0], pairs[:, 1])), shape = (n_zone_ids, n_zone_ids)).tocsr()
+    return graph.maximum(graph.T), zones
+
+def zone_travel_matrix(shp_path = '../data/external/taxi_zones_shape/taxi_zones.shp',
+                       lookup_path = '../data/external/taxi+_zone_lookup.csv', crossings = None, snap = 100):
+    """
+    Runs the all pairs shortest paths over the zone graph.
+    lookup_path: path of taxi+_zone_lookup.csv, used to check that every zone of the shape file is a known zone id
+    Returns a dictionary with:
+    distance: (n_zone_ids x n_zone_ids) float32 matrix of the network distance in miles between the zone centroids
+    hops: (n_zone_ids x n_zone_ids) uint8 matrix of the number of zone borders crossed on the shortest (in hops) path
+    Zones without geometry (0, 264 and 265: unknown and outside of NYC) and unreachable pairs get a nan distance and 255 hops.
+    """
+    graph, zones = zone_graph(shp_path, crossings = crossings, snap = snap)
+    lookup = pd.read_csv(lookup_path)
+    unknown = set(zones.LocationID) - set(lookup.LocationID)
+    assert not unknown, "Zones {} of the shape file are missing from the zone lookup".format(sorted(unknown))
+
+    distance = shortest_path(graph, method = 'D', directed = False)
+    hops = shortest_path(graph, method = 'D', directed = False, unweighted = True)
+
+    distance[np.isinf(distance)] = np.nan
+    hops[np.isinf(hops)] = 255
+    # a zone with no geometry is reachable from nothing, not even itself
+    no_geometry = ~np.isin(np.arange(n_zone_ids), zones.LocationID)
+    distance[no_geometry, :] = np.nan
+    distance[:, no_geometry] = np.nan
+    hops[no_geometry, :] = 255
+    hops[:, no_geometry] = 255
+    return {'distance': distance.astype(np.float32), 'hops': np.minimum(hops, 255).astype(np.uint8)}
+
+def save_zone_travel_matrix(travel, path = '../data/processed/zone_travel_matrix.npz'):
+    """
+    Saves the output of zone_travel_matrix (a few hundred KB compressed).
+    """
+    np.savez_compressed(path, distance = travel['distance'], hops = travel['hops'])
+
+def load_zone_travel_matrix(path = '../data/processed/zone_travel_matrix.npz'):
+    """
+    Loads the matrices saved by save_zone_travel_matrix.
+    """
+    with np.load(path) as f:
+        return {'distance': f['distance'], 'hops': f['hops']}
+
+def add_zone_travel_features(df, travel, pickup_col = 'pickup_taxizone_id', dropoff_col = 'dropoff_taxizone_id'):
+    """
+    Adds the zone_network_distance (miles) and zone_hops columns to df by looking up the (pickup zone, dropoff zone) pair of
+    every trip in the travel matrices. Trips with a missing or unknown zone get nan and 255.
+    df: dataframe with the zone ids assigned by assign_taxi_zones
+    travel: dictionary returned by zone_travel_matrix or load_zone_travel_matrix
+    """
+    pickup = pd.to_numeric(df[pickup_col], errors = 'coerce').to_numpy(dtype = np.float64)
+    dropoff = pd.to_numeric(df[dropoff_col], errors = 'coerce').to_numpy(dtype = np.float64)
+    valid = np.isfinite(pickup) & np.isfinite(dropoff)
+    valid &= (pickup >= 0) & (pickup < n_zone_ids) & (dropoff >= 0) & (dropoff < n_zone_ids)
+    # missing zones are pointed to zone 0, which has no geometry
+    pickup = np.where(valid, pickup, 0).astype(np.int64)
+    dropoff = np.where(valid, dropoff, 0).astype(np.int64)
+    df['zone_network_distance'] = travel['distance'][pickup, dropoff]
+    df['zone_hops'] = travel['hops'][pickup, dropoff]
+    return df
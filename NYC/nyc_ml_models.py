@@ -6,15 +6,29 @@ import sklearn.preprocessing
 from sklearn.linear_model import ElasticNet
 from sklearn.ensemble import RandomForestRegressor
 import xgboost as xgb
-from sklearn.model_selection import RandomizedSearchCV, GridSearchCV
+from sklearn.model_selection import RandomizedSearchCV, GridSearchCV, ParameterSampler
+from sklearn.base import clone
+from data_quantize import *
 import time
 
-def cv_optimize(model, parameters, X_train, y_train, n_folds = 3, scoring = 'r2'):
+# Scoring functions supported by cv_optimize_quantized (higher is better, as in the sklearn scorers)
+quantized_scorers = {'r2': r2_score,
+                     'neg_mean_squared_error': lambda y, p: -mean_squared_error(y, p),
+                     'neg_mean_absolute_error': lambda y, p: -mean_absolute_error(y, p)}
+
+def cv_optimize(model, parameters, X_train, y_train, n_folds = 3, scoring = 'r2', quantized = None):
     """
     Cross validation. Function to hypertune the model "model" with the input parameter distribution using
     "parameters" on the training data.
     The output will be the best estimator whose average score on all folds will be best. 
+    quantized: for XGBRegressor and RandomForestRegressor, True or the dictionary from quantized_training_data to run the search
+               on the quantized training data with cv_optimize_quantized instead of RandomizedSearchCV.
     """
+    if quantized and type(model).__name__ in ['XGBRegressor', 'RandomForestRegressor']:
+        if quantized is True:
+            quantized = quantized_training_data(X_train, y_train, n_folds = n_folds)
+        return cv_optimize_quantized(model, parameters, quantized, scoring = scoring)
+    
     reg = RandomizedSearchCV(estimator = model, param_distributions = parameters, 
                              cv = n_folds, scoring = scoring, random_state = 42, verbose = 2, n_jobs = -1)
     t0 = time.time()
@@ -26,12 +40,61 @@ def cv_optimize(model, parameters, X_train, y_train, n_folds = 3, scoring = 'r2'
     best = reg.best_estimator_
     return best
 
+def cv_optimize_quantized(model, parameters, data, n_iter = 10, scoring = 'r2', random_state = 42):
+    """
+    Same search as cv_optimize (n_iter random candidates, same folds and scoring) but every candidate is trained on the training
+    data quantized once by quantized_training_data, reusing the per fold xgboost DMatrix / RandomForest arrays cached in data.
+    model: XGBRegressor or RandomForestRegressor
+    data: dictionary returned by quantized_training_data
+    The output is the model with the best parameters set, not fitted (the tuning is done on the binned features, so the
+    final model should be fitted on the original features, which do_regression does).
+    """
+    model_name = type(model).__name__
+    if scoring not in quantized_scorers:
+        raise ValueError("scoring should be one of {} for the quantized search, got {}".format(sorted(quantized_scorers), scoring))
+    score_func = quantized_scorers[scoring]
+    candidates = list(ParameterSampler(parameters, n_iter = n_iter, random_state = random_state))
+    if model_name == 'XGBRegressor':
+        folds = xgb_fold_matrices(data)
+    else:
+        folds = rf_fold_arrays(data)
+    
+    t0 = time.time()
+    best_score, best_params = -np.inf, None
+    for params in candidates:
+        estimator = clone(model).set_params(**params)
+        if model_name == 'XGBRegressor':
+            xgb_params = {k: v for k, v in estimator.get_xgb_params().items() if v is not None}
+            xgb_params.pop('n_estimators', None)
+            xgb_params.update({'tree_method': 'hist', 'max_bin': data['max_bin']})
+            # n_estimators is None for XGBRegressor() on xgboost >= 2.0, which then trains 100 rounds
+            num_boost_round = estimator.get_params()['n_estimators'] or 100
+        scores = []
+        for fold in folds:
+            if model_name == 'XGBRegressor':
+                dtrain, dvalid = fold
+                booster = xgb.train(xgb_params, dtrain, num_boost_round = num_boost_round)
+                scores.append(score_func(dvalid.get_label(), booster.predict(dvalid)))
+            else:
+                X_fold, y_fold, X_valid, y_valid = fold
+                estimator.set_params(n_jobs = -1).fit(X_fold, y_fold)
+                scores.append(score_func(y_valid, estimator.predict(X_valid)))
+        print("{} mean {} = {:.4f}".format(params, scoring, np.mean(scores)))
+        if np.mean(scores) > best_score:
+            best_score, best_params = np.mean(scores), params
+    time_fit = time.time() - t0
+    print('\n\n\n=============================',model_name,'=================================\n')
+    print("It takes %.3f seconds for tuning " % (time_fit))
+    print("BEST PARAMS", best_params)
+    return clone(model).set_params(**best_params)
+
 def do_regression(model, parameters, df, dict_error, model_name = None, test_size = 0.3, add_zone_avg = False,
-                  fourier = False, scale = False):
+                  fourier = False, scale = False, sparse_ohe = None, quantized = None, target_encode = None):
           
-    X_train, X_test, y_train, y_test = prep_train_test(df, test_size = test_size, fourier = fourier, scale = scale)
+    X_train, X_test, y_train, y_test = prep_train_test(df, test_size = test_size, fourier = fourier, scale = scale,
+                                                       sparse_ohe = sparse_ohe, target_encode = target_encode)
     
-    model = cv_optimize(model, parameters, X_train, y_train)
+    model = cv_optimize(model, parameters, X_train, y_train, quantized = quantized)
     t0 = time.time()
     model = model.fit(X_train, y_train)
     time_fit = time.time() - t0 
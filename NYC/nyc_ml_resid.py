@@ -0,0 +1,218 @@
+"""
+This module contains user defined functions for analysing the residuals of the trained models on large test sets.
+Instead of scattering every single prediction, the predictions and the observed values are streamed in chunks into fixed
+binned aggregates (a predicted vs observed density grid and per zone/hour residual histograms). The plots are then drawn from
+those aggregates only, so the time to render them doesn't depend on the size of the test set.
+"""
+import pandas as pd
+import numpy as np
+import matplotlib.pyplot as plt
+import bokeh, bokeh.models, bokeh.palettes
+from bokeh.models import BasicTicker
+from plot_figs import plot_zone_values
+plt.style.use('bmh')
+plt.rcParams['figure.figsize'] = [10, 5]
+
+# Number of integer codes reserved for each grouping key. Taxi zone ids go from 1 to 265 (264 and 265 are the unknown zones).
+resid_keys_default = {'pickup_taxizone_id': 266, 'dropoff_taxizone_id': 266, 'pickup_hour': 24}
+
+def resid_accumulator(keys = None, resid_range = (-60, 60), resid_bins = 480, duration_range = (0, 120), grid_bins = 240):
+    """
+    Creates an empty accumulator to stream the predictions and observed values into.
+    keys: dictionary of {column name: number of integer codes} to aggregate the residuals by.
+          default: pickup zone, dropoff zone and pickup hour
+    resid_range: (min, max) range of the residual histograms used to compute the quantiles. Residuals outside the range are
+                 counted in the first/last bin. The mean and std are computed exactly irrespective of the range.
+    resid_bins: number of bins of the residual histograms
+    duration_range: (min, max) range of the predicted vs observed density grid
+    grid_bins: number of bins along each axis of the predicted vs observed density grid
+    Note: the ranges are in the same units as the values passed to update_resid_accumulator after dividing by divide_by
+          (minutes by default).
+    """
+    if keys is None:
+        keys = resid_keys_default
+    acc = {'resid_edges': np.linspace(resid_range[0], resid_range[1], resid_bins + 1),
+           'grid_edges': np.linspace(duration_range[0], duration_range[1], grid_bins + 1),
+           'grid': np.zeros(grid_bins * grid_bins),
+           'keys': {}}
+    for key, n_codes in keys.items():
+        acc['keys'][key] = {'N': np.zeros(n_codes), 'sum': np.zeros(n_codes), 'sumsq': np.zeros(n_codes),
+                            'hist': np.zeros(n_codes * resid_bins)}
+    return acc
+
+def _bin_index(values, edges):
+    """
+    Returns the bin index of every value for the equally spaced bin edges. Values outside the edges go to the first/last bin.
+    """
+    n_bins = len(edges) - 1
+    idx = ((values - edges[0]) * (n_bins / (edges[-1] - edges[0]))).astype(np.int64)
+    return np.clip(idx, 0, n_bins - 1)
+
+def update_resid_accumulator(acc, y_pred, y_truth, X, divide_by = 60):
+    """
+    Adds one chunk of predictions to the accumulator acc (in place).
+    y_pred: predicted values of y for the chunk
+    y_truth: observed values of y for the chunk
+    X: dataframe holding the key columns of acc for the chunk (rows in the same order as y_pred)
+    divide_by: default 60 to aggregate the trip duration in minutes. Use 1 to keep the values as they are.
+    Residuals are defined as in residual_plot, i.e. observed - predicted, so negative residuals are over predictions.
+    """
+    y_pred = np.asarray(y_pred, dtype = np.float64) / divide_by
+    y_truth = np.asarray(y_truth, dtype = np.float64) / divide_by
+    assert len(y_pred) == len(y_truth) == len(X), "Length of predicted, observed y array and X is not the same"
+    residuals = y_truth - y_pred
+
+    resid_edges = acc['resid_edges']
+    n_resid_bins = len(resid_edges) - 1
+    resid_idx = _bin_index(residuals, resid_edges)
+
+    grid_edges = acc['grid_edges']
+    n_grid_bins = len(grid_edges) - 1
+    cell = _bin_index(y_truth, grid_edges) * n_grid_bins + _bin_index(y_pred, grid_edges)
+    acc['grid'] += np.bincount(cell, minlength = n_grid_bins * n_grid_bins)
+
+    for key, stats in acc['keys'].items():
+        n_codes = len(stats['N'])
+        codes = pd.to_numeric(X[key], errors = 'coerce').to_numpy(dtype = np.float64)
+        # trips without a zone (nan) or with an unexpected code are left out of the per key aggregates
+        valid = np.isfinite(codes) & (codes >= 0) & (codes < n_codes)
+        codes = codes[valid].astype(np.int64)
+        resid = residuals[valid]
+        stats['N'] += np.bincount(codes, minlength = n_codes)
+        stats['sum'] += np.bincount(codes, weights = resid, minlength = n_codes)
+        stats['sumsq'] += np.bincount(codes, weights = resid**2, minlength = n_codes)
+        stats['hist'] += np.bincount(codes * n_resid_bins + resid_idx[valid], minlength = n_codes * n_resid_bins)
+    return acc
+
+def accumulate_residuals(y_pred, y_truth, X, chunk_size = 1000000, divide_by = 60, acc = None, **kwargs):
+    """
+    Streams the full predicted and observed arrays into an accumulator in chunks of chunk_size rows so that the temporary
+    arrays never grow with the size of the test set.
+    acc: existing accumulator to add to. If None a new one is created with resid_accumulator(**kwargs).
+    """
+    if acc is None:
+        acc = resid_accumulator(**kwargs)
+    y_pred = np.asarray(y_pred)
+    y_truth = np.asarray(y_truth)
+    for start in range(0, len(y_pred), chunk_size):
+        stop = start + chunk_size
+        update_resid_accumulator(acc, y_pred[start:stop], y_truth[start:stop], X.iloc[start:stop], divide_by = divide_by)
+    return acc
+
+def _hist_quantiles(hist, edges, quantiles):
+    """
+    Interpolates the quantiles of each row of the 2D histogram hist (one row per group) with the bin edges.
+    """
+    width = edges[1] - edges[0]
+    cum = hist.cumsum(axis = 1)
+    total = cum[:, -1]
+    out = {}
+    for q in quantiles:
+        target = q * total
+        idx = np.minimum((cum < target[:, None]).sum(axis = 1), hist.shape[1] - 1)
+        rows = np.arange(hist.shape[0])
+        prev = np.where(idx > 0, cum[rows, idx - 1], 0)
+        in_bin = hist[rows, idx]
+        frac = np.divide(target - prev, in_bin, out = np.zeros_like(target), where = in_bin > 0)
+        value = edges[idx] + frac * width
+        value[total == 0] = np.nan
+        out['q' + str(int(round(q * 100)))] = value
+    return out
+
+def resid_summary(acc, key, quantiles = (0.1, 0.5, 0.9)):
+    """
+    Returns a dataframe with the number of trips (N), mean, std and the quantiles of the residuals for each value of key.
+    Only the values of key that had trips are returned.
+    """
+    stats = acc['keys'][key]
+    n_codes = len(stats['N'])
+    N = stats['N']
+    with np.errstate(invalid = 'ignore', divide = 'ignore'):
+        mean = stats['sum'] / N
+        std = np.sqrt(np.maximum(stats['sumsq'] / N - mean**2, 0))
+    summary = pd.DataFrame({key: np.arange(n_codes), 'N': N.astype(np.int64), 'mean': mean, 'std': std})
+    hist = stats['hist'].reshape(n_codes, -1)
+    for name, value in _hist_quantiles(hist, acc['resid_edges'], quantiles).items():
+        summary[name] = value
+    return summary[summary.N > 0].reset_index(drop = True)
+
+def plot_predvstrue_hexbin(acc, model_name = None, gridsize = 60, log = True):
+    """
+    Plots the density of the observed against the predicted values from the accumulator acc. This is the binned version of
+    plot_predvstrue_reg and takes the same time irrespective of the number of predictions.
+    """
+    print("\nPlotting Predicted vs Observed trip duration density")
+    edges = acc['grid_edges']
+    centers = (edges[:-1] + edges[1:]) / 2
+    truth_c, pred_c = np.meshgrid(centers, centers, indexing = 'ij')
+    counts = acc['grid']
+    nonzero = counts > 0
+    fig, ax = plt.subplots(1,1, figsize=(8,8))
+    hb = ax.hexbin(truth_c.ravel()[nonzero], pred_c.ravel()[nonzero], C = counts[nonzero], reduce_C_function = np.sum,
+                   gridsize = gridsize, bins = 'log' if log else None, cmap = 'viridis', mincnt = 1,
+                   extent = (edges[0], edges[-1], edges[0], edges[-1]))
+    _ = fig.colorbar(hb, ax = ax, label = 'number of trips')
+    _ = plt.xlabel("Observed ")
+    _ = plt.ylabel("Predicted ")
+    _ = plt.title("Observed vs Predicted {}".format(model_name))
+    #plotting 45 deg line to see how the prediction differs from the observed values
+    x = np.linspace(edges[0], edges[-1])
+    _ = ax.plot(x, x, color = 'red')
+    return ax
+
+def plot_resid_by_hour(acc, key = 'pickup_hour'):
+    """
+    Plots the mean residual with the 10-90% quantile band for every hour of the day.
+    """
+    summary = resid_summary(acc, key, quantiles = (0.1, 0.5, 0.9))
+    print("\nPlotting residuals by {}".format(key.replace("_", " ")))
+    fig, ax = plt.subplots(1,1)
+    _ = ax.fill_between(summary[key], summary.q10, summary.q90, alpha = 0.3, label = '10-90% quantiles')
+    _ = ax.plot(summary[key], summary.q50, label = 'median')
+    _ = ax.plot(summary[key], summary['mean'], marker = 'o', label = 'mean')
+    _ = ax.axhline(0, color = 'black', linewidth = 0.5)
+    _ = plt.xlabel(key.replace("_", " "))
+    _ = plt.ylabel("Residuals")
+    _ = plt.title("Residuals by {}".format(key.replace("_", " ")))
+    _ = plt.legend()
+    return ax
+
+def plot_zone_residuals(acc, nyc_shp, col_to_plot = 'pickup_taxizone_id', stat = 'mean', limit = None):
+    """
+    Plots a residual statistic for all taxi zones on the NYC zones map using plot_zone_values.
+    nyc_shp: shape file
+    col_to_plot: pickup_taxizone_id or dropoff_taxizone_id
+    stat: one of the resid_summary columns, e.g. 'mean', 'std', 'q50'
+    limit: colorbar range is (-limit, limit) for the signed statistics and (0, limit) for std. default: 95th percentile of
+           the absolute value of the statistic over the zones
+    """
+    summary = resid_summary(acc, col_to_plot)
+    counts = summary[[col_to_plot]].copy()
+    counts['N'] = summary[stat]
+    if limit is None:
+        limit = np.nanpercentile(np.abs(counts.N), 95)
+    if stat == 'std':
+        color_mapper = bokeh.models.LinearColorMapper(palette = bokeh.palettes.Viridis256, low = 0, high = limit)
+    else:
+        color_mapper = bokeh.models.LinearColorMapper(palette = bokeh.palettes.RdBu11, low = -limit, high = limit)
+    tag = "residual " + stat
+    title = "NYC Taxi "+col_to_plot.split("_")[0]+"s residual " + stat + " map"
+    return plot_zone_values(counts, nyc_shp, col_to_plot = col_to_plot, color_mapper = color_mapper,
+                            ticker = BasicTicker(), tag = tag, cbar_title = tag, title = title, tick_format = '%.1f')
+
+def residual_diagnostics(y_pred, y_truth, X, nyc_shp = None, model_name = None, **kwargs):
+    """
+    Runs the full set of binned residual diagnostics: the predicted vs observed density, the residuals by hour and, if nyc_shp
+    is passed, the pickup and dropoff zone maps of the mean residuals.
+    Returns the accumulator and the list of bokeh zone maps.
+    """
+    acc = accumulate_residuals(y_pred, y_truth, X, **kwargs)
+    plot_predvstrue_hexbin(acc, model_name = model_name)
+    if 'pickup_hour' in acc['keys']:
+        plot_resid_by_hour(acc)
+    zone_maps = []
+    if nyc_shp is not None:
+        for col in ['pickup_taxizone_id', 'dropoff_taxizone_id']:
+            if col in acc['keys']:
+                zone_maps.append(plot_zone_residuals(acc, nyc_shp, col_to_plot = col))
+    return acc, zone_maps
@@ -77,11 +77,58 @@ def bokeh_distplot(data, category_col = ['trip_bins_minutes'], value = 'pickup_l
     p.legend.location = legend_loc
     return(p)
         
-def zone_plot(nyc_shp, fill_color = 'LocationID'):
+# Simplified zone outlines already converted to bokeh patches, keyed by the id of the shape file and the tolerance
+_zone_patches_cache = {}
+
+def zone_patches(nyc_shp, tolerance = 0.0001):
+    """
+    Simplifies the zone polygons of nyc_shp and converts them to the 'xs' and 'ys' patch coordinates used by bokeh. This is
+    done only once per shape file and tolerance, the result is cached and reused by every zone map after that.
+    nyc_shp: shape file
+    tolerance: maximum distance the simplified outlines may deviate from the original ones, in the units of the shape file
+               crs (degrees for epsg:4326, 0.0001 deg is ~10 m). Use 0 or None to keep the full resolution geometry.
+    Multi polygon zones (islands) are put in a single patch with the polygons separated by nan values.
+    """
+    key = (id(nyc_shp), tolerance)
+    if key in _zone_patches_cache and _zone_patches_cache[key][0] is nyc_shp:
+        return _zone_patches_cache[key][1]
+    
+    geometry = nyc_shp.geometry
+    if tolerance:
+        geometry = geometry.simplify(tolerance, preserve_topology = True)
+    xs, ys = [], []
+    for geom in geometry:
+        polygons = geom.geoms if geom.geom_type == 'MultiPolygon' else [geom]
+        x, y = [], []
+        for polygon in polygons:
+            px, py = polygon.exterior.coords.xy
+            x.extend(list(px) + [np.nan])
+            y.extend(list(py) + [np.nan])
+        xs.append(np.array(x[:-1]))
+        ys.append(np.array(y[:-1]))
+    
+    # keeping a reference to nyc_shp so that its id can't be reused by another shape file while cached
+    _zone_patches_cache[key] = (nyc_shp, (xs, ys))
+    return xs, ys
+
+def zone_source(nyc_shp, tolerance = 0.0001):
+    """
+    Creates the bokeh ColumnDataSource of the taxi zones with the cached simplified patches and all the non geometry columns
+    of nyc_shp.
+    """
+    xs, ys = zone_patches(nyc_shp, tolerance = tolerance)
+    data = {'xs': xs, 'ys': ys}
+    for col in nyc_shp.columns:
+        if col != nyc_shp.geometry.name:
+            data[col] = nyc_shp[col].tolist()
+    return ColumnDataSource(data = data)
+
+def zone_plot(nyc_shp, fill_color = 'LocationID', tolerance = 0.0001):
     """
     Plots the zone and borough boundaries.
+    tolerance: simplification tolerance of the zone outlines, see zone_patches.
     """
-    gjds = bokeh.models.GeoJSONDataSource(geojson = nyc_shp.to_json())
+    source = zone_source(nyc_shp, tolerance = tolerance)
     TOOLS = "pan, wheel_zoom,reset,hover,save"
     
     plot_zone = bokeh.plotting.figure(title = "NYC Taxi Zones", tools = TOOLS,
@@ -92,7 +139,7 @@ def zone_plot(nyc_shp, fill_color = 'LocationID'):
     plot_zone.patches('xs', 'ys', 
               fill_color = {'field': fill_color, 'transform': color_mapper},#borough_num
               fill_alpha = 1., line_color="black", line_width = 0.5,          
-              source = gjds)
+              source = source)
     
     plot_zone.grid.grid_line_color = None
     
@@ -214,7 +261,8 @@ def plot_single_gmaps(data, latitude_column = 'pickup_latitude', longitude_colum
     return(plot, output_file("gmap.html"))
 
 
-def plot_zone_trips_counts(df, nyc_shp, to_plot = 'count', divide_by = 60, col_to_plot = "pickup_taxizone_id"):
+def plot_zone_trips_counts(df, nyc_shp, to_plot = 'count', divide_by = 60, col_to_plot = "pickup_taxizone_id",
+                           tolerance = 0.0001):
     
     """ Plots the total number of rides or the average trip duration within all zones in NYC. 
         df: dataframe
@@ -222,6 +270,7 @@ def plot_zone_trips_counts(df, nyc_shp, to_plot = 'count', divide_by = 60, col_t
         to_plot: 'count' if count of rides is to be plotted or 'column name' of the column to be used as the displayed values
         divide_by: default 60 to plot the 'trip duration' column in minutes. Use 1 for any other column to be used as it is.
         col_to_plot: pickup_taxizone_id or dropoff_taxizone_id
+        tolerance: simplification tolerance of the zone outlines, see zone_patches.
     """
     
     df = df.copy()
@@ -242,14 +291,41 @@ def plot_zone_trips_counts(df, nyc_shp, to_plot = 'count', divide_by = 60, col_t
         color_mapper = bokeh.models.LinearColorMapper(palette = bokeh.palettes.Turbo256, low = np.percentile(df[to_plot]/60, 5), 
                                                       high = np.percentile(df[to_plot]/60, 95))
         
-    counts2 = nyc_shp.merge(counts, left_on='LocationID', 
-                            #right_index=True, 
-                            right_on = col_to_plot,
-                            how='left')
+    title = "NYC Taxi "+col_to_plot.split("_")[0]+"s " + to_plot + " map"
+    return plot_zone_values(counts, nyc_shp, col_to_plot = col_to_plot, color_mapper = color_mapper, ticker = ticker,
+                            tag = tag, cbar_title = cbar_title, title = title, tolerance = tolerance)
+
+def _zone_values(counts, location_ids, col_to_plot):
+    """
+    Aligns the 'N' values of counts with the zones in location_ids. Zones missing from counts get nan.
+    """
+    return counts.set_index(col_to_plot)['N'].reindex(location_ids).to_numpy()
+
+def plot_zone_values(counts, nyc_shp, col_to_plot = "pickup_taxizone_id", color_mapper = None, ticker = None,
+                     tag = "N", cbar_title = "", title = "NYC Taxi zones map", tick_format = '%d', tolerance = 0.0001):
+    
+    """ Plots precomputed per-zone values on the taxi zone map. 
+        counts: dataframe with one row per zone, the zone id in col_to_plot and the value to display in column 'N'
+        nyc_shp: shape file
+        col_to_plot: pickup_taxizone_id or dropoff_taxizone_id
+        color_mapper: bokeh color mapper for 'N'. default: linear Turbo256 mapper over the range of 'N'
+        ticker: bokeh ticker for the colorbar. default: BasicTicker
+        tag: label of the value in the hover tooltip
+        cbar_title: title of the colorbar
+        tick_format: printf style format of the colorbar ticks
+        tolerance: simplification tolerance of the zone outlines, see zone_patches.
+    Use update_zone_values to change the displayed values of the returned plot without sending the zone outlines again.
+    """
     
-    gjds = bokeh.models.GeoJSONDataSource(geojson = counts2.to_json())
+    if color_mapper is None:
+        color_mapper = bokeh.models.LinearColorMapper(palette = bokeh.palettes.Turbo256, low = counts.N.min(), 
+                                                      high = counts.N.max())
+    if ticker is None:
+        ticker = BasicTicker()
+        
+    source = zone_source(nyc_shp, tolerance = tolerance)
+    source.data['N'] = _zone_values(counts, source.data['LocationID'], col_to_plot)
     TOOLS = "pan,wheel_zoom,reset,hover,save"
-    title = "NYC Taxi "+col_to_plot.split("_")[0]+"s " + to_plot + " map"
     p = bokeh.plotting.figure(title = title, tools = TOOLS,
                               x_axis_location = None, y_axis_location = None,) 
                               #plot_width = np.int(1.08*500), plot_height = 500)
@@ -257,7 +333,7 @@ def plot_zone_trips_counts(df, nyc_shp, to_plot = 'count', divide_by = 60, col_t
     p.patches('xs', 'ys', 
               fill_color = {'field': 'N', 'transform': color_mapper},
               fill_alpha = 1., line_color = "black", line_width=0.5,          
-              source = gjds)
+              source = source, name = 'zones')
     
     p.grid.grid_line_color = None
     
@@ -275,7 +351,7 @@ def plot_zone_trips_counts(df, nyc_shp, to_plot = 'count', divide_by = 60, col_t
     color_bar = bokeh.models.ColorBar(
                                     color_mapper = color_mapper, orientation='horizontal',
                                     ticker = ticker,
-                                    formatter=bokeh.models.PrintfTickFormatter(format = '%d'),
+                                    formatter=bokeh.models.PrintfTickFormatter(format = tick_format),
                                     label_standoff = 12, border_line_color = None, 
                                     location = (0,0), title = cbar_title)
     
@@ -283,6 +359,16 @@ def plot_zone_trips_counts(df, nyc_shp, to_plot = 'count', divide_by = 60, col_t
     
     return p
 
+def update_zone_values(p, counts, col_to_plot = "pickup_taxizone_id"):
+    """
+    Replaces the displayed per-zone values of a plot created by plot_zone_values or plot_zone_trips_counts. Only the 'N' column
+    of the data source changes, so in a notebook or bokeh server document only that column is sent to the browser.
+    counts: dataframe with one row per zone, the zone id in col_to_plot and the new value in column 'N'
+    """
+    source = p.select_one({'name': 'zones'}).data_source
+    source.data['N'] = _zone_values(counts, source.data['LocationID'], col_to_plot)
+    return p
+
 def plot_gmaps(data, slider = False, latitude_column= ['pickup_latitude', 'dropoff_latitude'], 
                longitude_column = ['pickup_longitude', 'dropoff_longitude'],
                color_column = 'trip_duration', size_column = 3.0,
@@ -0,0 +1,243 @@
+"""
+Bulk offline scoring of taxi trips with a saved (pickled) model.
+
+The trips are read from a parquet file/directory or a csv file in batches, the features are added with the same code used for
+the training data (add_trip_features and bearing from data_prep) and the predictions are made by a pool of worker processes,
+each with its own copy of the model. A reader thread, a bounded queue of batches and a bounded number of batches in flight
+keep the memory constant whatever the size of the input, while the reading, the predictions and the writing of the parquet
+output overlap.
+
+The model must use features that can be computed from the raw trips (default_features, or columns already in the input).
+The models saved by the notebooks also use the zone clusters (pickup_zone_cluster, dropoff_zone_cluster), which are not
+computed here, so score_file checks the features before starting and names the missing ones. A model for this command can be
+trained on default_features with do_regression and pickled, e.g. to notebooks/trained_models/xgb_trip_features.sav.
+
+The script is run by its path rather than installed as a console script, because the NYC modules import each other by their
+bare names (from data_prep import ...), which only works with the NYC directory on the path.
+
+Usage (from the repository root):
+    python NYC/score_trips.py notebooks/trained_models/xgb_trip_features.sav data/interim/nyc_data_2016.parquet predictions.parquet
+"""
+import os
+import sys
+import glob
+import time
+import pickle
+import queue
+import argparse
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import pandas as pd
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pyarrow.compute as pc
+from data_prep import add_trip_features, bearing
+from data_encode import weekday_codes
+
+# Features that can be computed from the raw trips (the features of the ML notebooks without the zone clusters), used when the
+# model doesn't store its feature names
+default_features = ['vendorid', 'passenger_count', 'pickup_longitude', 'pickup_latitude', 'dropoff_longitude',
+                    'dropoff_latitude', 'pickup_month', 'pickup_day', 'pickup_hour', 'pickup_weekday', 'holiday',
+                    'distance_hav', 'bearing']
+
+# Input column names renamed by trip_features: the raw csv files (tpep_*) and the interim parquet files (vendor_id) don't use
+# the training names
+input_renames = {'tpep_pickup_datetime': 'pickup_datetime', 'tpep_dropoff_datetime': 'dropoff_datetime',
+                 'vendor_id': 'vendorid'}
+
+# Columns added by trip_features to the raw trips
+computed_features = ['pickup_date', 'pickup_month', 'pickup_day', 'pickup_hour', 'pickup_weekday', 'holiday', 'distance_hav',
+                     'bearing']
+
+# Sentinel put in the queue by the reader once all the batches are read
+_end_of_input = None
+
+def _decode_json_columns(batch):
+    """
+    The string columns of the interim parquet files were written with the JSON logical type, which recent pyarrow versions
+    read as arrow.json columns of quoted strings ('"2016-05-08 02:04:04"'). Returns the record batch with these columns
+    turned back into plain strings.
+    """
+    columns = []
+    for field, column in zip(batch.schema, batch.columns):
+        if getattr(field.type, 'extension_name', None) == 'arrow.json':
+            column = pc.replace_substring_regex(column.storage, pattern = '^"(.*)"$', replacement = '\\1')
+        columns.append(column)
+    return pa.RecordBatch.from_arrays(columns, names = batch.schema.names)
+
+def read_batches(path, batch_size = 100000):
+    """
+    Yields the trips of path as dataframes of at most batch_size rows. path can be a csv file or a parquet file or directory
+    of parquet files (such as data/interim/nyc_data_2016.parquet).
+    """
+    if path.endswith('.csv') or path.endswith('.csv.gz'):
+        for batch in pd.read_csv(path, chunksize = batch_size):
+            yield batch
+        return
+    files = sorted(glob.glob(os.path.join(path, '*.parquet'))) if os.path.isdir(path) else [path]
+    for f in files:
+        for batch in pq.ParquetFile(f).iter_batches(batch_size = batch_size):
+            yield _decode_json_columns(batch).to_pandas()
+
+def input_columns(path):
+    """
+    Returns the column names of the trips of path (csv file, parquet file or directory of parquet files) without reading the
+    trips.
+    """
+    if path.endswith('.csv') or path.endswith('.csv.gz'):
+        return list(pd.read_csv(path, nrows = 0).columns)
+    files = sorted(glob.glob(os.path.join(path, '*.parquet'))) if os.path.isdir(path) else [path]
+    return pq.ParquetFile(files[0]).schema_arrow.names
+
+def check_features(features, columns):
+    """
+    Raises a ValueError naming the model features that are neither input columns nor computed by trip_features.
+    """
+    columns = [input_renames.get(col, col) for col in columns]
+    missing = [f for f in features if f not in columns and f not in computed_features]
+    if missing:
+        raise ValueError("The model features {} are not in the input and can't be computed from the raw trips, add them to "
+                         "the input or use a model trained on default_features".format(missing))
+
+def trip_features(batch):
+    """
+    Adds the model features to a batch of raw trips, the same way as for the training data.
+    """
+    batch = batch.rename(columns = input_renames)
+    batch['pickup_datetime'] = pd.to_datetime(batch['pickup_datetime'])
+    batch = add_trip_features(batch)
+    batch['bearing'] = bearing([batch.pickup_latitude.to_numpy(), batch.pickup_longitude.to_numpy(),
+                                batch.dropoff_latitude.to_numpy(), batch.dropoff_longitude.to_numpy()])
+    # the models were trained with the weekday as the dayofweek number (Monday = 0)
+    batch['pickup_weekday'] = weekday_codes(batch.pickup_weekday)
+    return batch
+
+def model_features(model):
+    """
+    Returns the feature names stored in the model (sklearn models fitted on dataframes, XGBoost) or default_features.
+    """
+    names = getattr(model, 'feature_names_in_', None)
+    if names is None and hasattr(model, 'get_booster'):
+        names = model.get_booster().feature_names
+    return [str(name) for name in names] if names is not None else default_features
+
+_worker_model = None
+
+def _init_worker(model_path):
+    """
+    Loads the model once in every worker process.
+    """
+    global _worker_model
+    with open(model_path, 'rb') as f:
+        _worker_model = pickle.load(f)
+
+def _score_batch(batch, first_row, features, keep_cols):
+    """
+    Scores one batch in a worker process. Returns the output dataframe: the row number of every trip in the input, the
+    keep_cols columns and the predicted trip duration.
+    """
+    X = trip_features(batch.copy())[features].astype(np.float64)
+    out = pd.DataFrame({'row': np.arange(first_row, first_row + len(batch), dtype = np.int64)})
+    for col in keep_cols:
+        out[col] = batch[col].to_numpy()
+    out['trip_duration_pred'] = _worker_model.predict(X)
+    return out
+
+def _read_into_queue(path, batch_size, batches):
+    """
+    Reader thread: puts the (first row, batch) pairs in the bounded queue batches, then the end of input sentinel. Blocks
+    when the queue is full, which is what keeps the memory constant.
+    """
+    try:
+        first_row = 0
+        for batch in read_batches(path, batch_size = batch_size):
+            batches.put((first_row, batch))
+            first_row += len(batch)
+    except Exception as e:
+        batches.put(e)
+    batches.put(_end_of_input)
+
+def score_file(model_path, input_path, output_path, features = None, keep_cols = None, batch_size = 100000,
+               workers = None, report_every = 10):
+    """
+    Scores all the trips of input_path with the pickled model of model_path and writes the predictions to the parquet file
+    output_path, in the order of the input.
+    features: list of model feature names. default: the names stored in the model, else default_features
+    keep_cols: input columns copied to the output next to the predictions
+    batch_size: number of trips per batch
+    workers: number of worker processes. default: number of cpus
+    report_every: the throughput is printed every report_every batches
+    Returns the number of trips scored.
+    """
+    workers = workers or os.cpu_count()
+    keep_cols = keep_cols or []
+    if features is None:
+        with open(model_path, 'rb') as f:
+            features = model_features(pickle.load(f))
+    check_features(features, input_columns(input_path))
+
+    batches = queue.Queue(maxsize = 2 * workers)
+    reader = threading.Thread(target = _read_into_queue, args = (input_path, batch_size, batches), daemon = True)
+    reader.start()
+
+    writer = None
+    n_rows, n_batches = 0, 0
+    t0 = time.time()
+
+    def write(out):
+        nonlocal writer, n_rows, n_batches
+        table = pa.Table.from_pandas(out, preserve_index = False)
+        if writer is None:
+            writer = pq.ParquetWriter(output_path, table.schema)
+        writer.write_table(table.cast(writer.schema))
+        n_rows += len(out)
+        n_batches += 1
+        if n_batches % report_every == 0:
+            print("{} trips scored, {:.0f} trips/sec".format(n_rows, n_rows / (time.time() - t0)))
+
+    try:
+        with ProcessPoolExecutor(max_workers = workers, initializer = _init_worker, initargs = (model_path,)) as pool:
+            pending = deque()
+            while True:
+                item = batches.get()
+                if item is _end_of_input:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                first_row, batch = item
+                pending.append(pool.submit(_score_batch, batch, first_row, features, keep_cols))
+                # at most `workers` batches in flight, the oldest one is written while the others are being scored
+                if len(pending) >= workers:
+                    write(pending.popleft().result())
+            while pending:
+                write(pending.popleft().result())
+    finally:
+        if writer is not None:
+            writer.close()
+
+    time_score = time.time() - t0
+    print("It takes %.3f seconds for scoring %d trips (%.0f trips/sec)" % (time_score, n_rows, n_rows / max(time_score, 1e-9)))
+    return n_rows
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = 'Predict the trip duration of all the trips of a parquet or csv file with '
+                                                   'a saved model and write the predictions to a parquet file.')
+    parser.add_argument('model', help = 'pickled model, e.g. notebooks/trained_models/xgb_trip_features.sav')
+    parser.add_argument('input', help = 'parquet file, directory of parquet files or csv file with the trips')
+    parser.add_argument('output', help = 'parquet file to write the predictions to')
+    parser.add_argument('--features', help = 'comma separated model features (default: read from the model)')
+    parser.add_argument('--keep', default = '', help = 'comma separated input columns to copy to the output')
+    parser.add_argument('--batch-size', type = int, default = 100000, help = 'number of trips per batch')
+    parser.add_argument('--workers', type = int, default = None, help = 'number of worker processes (default: cpu count)')
+    args = parser.parse_args(argv)
+
+    features = args.features.split(',') if args.features else None
+    keep_cols = [col for col in args.keep.split(',') if col]
+    score_file(args.model, args.input, args.output, features = features, keep_cols = keep_cols,
+               batch_size = args.batch_size, workers = args.workers)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())